@@ -0,0 +1,326 @@
+# coding=utf-8
+"""
+Contains the endpoints that are used to communicate with the language server.
+"""
+
+import os
+import json
+import logging
+import selectors
+import threading
+from contextlib import contextmanager
+from pylspclient import JsonRpcEndpoint, LspEndpoint, lsp_structs
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # Fall back to json
+
+_log = logging.getLogger(__name__)
+
+READ_SIZE = 1 << 16  # The maximum number of bytes that are read at once
+HEADER_END = b'\r\n\r\n'
+LEN_HEADER = b'content-length:'
+IOV_MAX = 1024  # The maximum number of buffers for a single writev() call
+
+
+class PipeEndpoint(JsonRpcEndpoint):
+    """A JsonRpcEndpoint that waits for the server's stdout and stderr with a
+    selector. Output is read in large chunks as soon as it becomes available,
+    and is then split into messages, whereas pylspclient does a readline()
+    for each header and a read() for each body. stderr is drained, because
+    otherwise the server blocks once the stderr pipe is full.
+
+    Selectors don't work with pipes on Windows, so this endpoint can only be
+    used on POSIX systems.
+    """
+
+    def __init__(self, stdin, stdout, stderr=None):
+
+        super().__init__(stdin, stdout)
+        self._stdin_fd = stdin.fileno()
+        self._stdout_fd = stdout.fileno()
+        self._stderr_fd = None if stderr is None else stderr.fileno()
+        self._buffer = bytearray()
+        self._batch = None
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._stdout_fd, selectors.EVENT_READ)
+        if self._stderr_fd is not None:
+            self._selector.register(self._stderr_fd, selectors.EVENT_READ)
+
+    def send_request(self, message):
+        """Sends a message. The header and the body are sent with a single
+        writev() call straight to the file descriptor, so that they don't need
+        to be concatenated or copied into stdin's buffer first. The content
+        length is the length of the encoded body.
+        """
+
+        body = _dumps(message)
+        header = b'Content-Length: %d\r\n\r\n' % len(body)
+        with self.write_lock:
+            if self._batch is None:
+                buffers = [header, body]
+            else:
+                self._batch += [header, body]
+                # Requests (and responses) have an id, and are waited for.
+                # They are therefore written right away, together with the
+                # notifications that were queued before them.
+                if 'id' not in message:
+                    return
+                buffers, self._batch = self._batch, []
+            _write_all(self._stdin_fd, buffers)
+
+    @contextmanager
+    def batch(self):
+        """Queues the notifications that are sent within the context, and
+        writes them all at once when the context is left, or together with
+        the next request. This way, a didChange and the request that follows
+        it reach the server with a single write.
+        """
+
+        with self.write_lock:
+            self._batch = []
+        try:
+            yield
+        finally:
+            with self.write_lock:
+                buffers, self._batch = self._batch, None
+                if buffers:
+                    try:
+                        _write_all(self._stdin_fd, buffers)
+                    except BrokenPipeError:
+                        # The server quit, and has been restarted with a new
+                        # endpoint that doesn't need these notifications.
+                        _log.debug('server quit before batch was written')
+
+    def recv_response(self):
+        """Returns the next message, or None if the server quit."""
+
+        with self.read_lock:
+            while True:
+                message = self._next_message()
+                if message is not None:
+                    return message
+                if not self._read():
+                    return None
+
+    def _read(self):
+        """Waits until the server produces output and reads it. Returns False
+        if the server closed stdout, and True otherwise.
+        """
+
+        while True:
+            for key, _ in self._selector.select():
+                data = os.read(key.fd, READ_SIZE)
+                if key.fd == self._stdout_fd:
+                    if not data:
+                        return False
+                    self._buffer += data
+                    return True
+                if not data:
+                    self._selector.unregister(key.fd)
+                    continue
+                _log.debug(data.decode('utf-8', errors='replace'))
+
+    def _next_message(self):
+        """Returns the next message from the buffer, or None if the buffer
+        doesn't contain a complete message yet.
+        """
+
+        header_end = self._buffer.find(HEADER_END)
+        if header_end < 0:
+            return None
+        body_start = header_end + len(HEADER_END)
+        try:
+            message_size = _message_size(
+                bytes(self._buffer[:header_end]).split(b'\r\n')
+            )
+        except lsp_structs.ResponseError:
+            # The bad header is dropped, because pylspclient keeps reading
+            # after a ResponseError, and would otherwise get it again.
+            del self._buffer[:body_start]
+            raise
+        body_end = body_start + message_size
+        if len(self._buffer) < body_end:
+            return None
+        body = self._buffer[body_start:body_end]
+        del self._buffer[:body_end]
+        return _loads(body)
+
+
+class BufferedEndpoint(JsonRpcEndpoint):
+    """A JsonRpcEndpoint that reads and writes through the buffered stdin and
+    stdout, like pylspclient's endpoint, but that uses orjson when available.
+    This endpoint is used on Windows, where PipeEndpoint doesn't work.
+    """
+    
+    def send_request(self, message):
+        """Sends a message."""
+        
+        body = _dumps(message)
+        header = b'Content-Length: %d\r\n\r\n' % len(body)
+        with self.write_lock:
+            self.stdin.write(header)
+            self.stdin.write(body)
+            self.stdin.flush()
+
+    def recv_response(self):
+        """Returns the next message, or None if the server quit."""
+        
+        with self.read_lock:
+            headers = []
+            while True:
+                line = self.stdout.readline()
+                if not line:
+                    return None
+                line = line.rstrip(b'\r\n')
+                if not line:
+                    break
+                headers.append(line)
+            return _loads(self.stdout.read(_message_size(headers)))
+
+
+class CancellingLspEndpoint(LspEndpoint):
+    """An LspEndpoint that sends a $/cancelRequest when a request times out,
+    so that the server can stop working on it, and that ignores responses
+    that arrive after the request was abandoned. pylspclient's LspEndpoint
+    doesn't forget timed out requests, and a late response for an unknown
+    request would stop its reader thread. When the server quits, requests
+    that are still waiting fail right away with a ConnectionError, rather than
+    when they time out.
+    """
+
+    def __init__(self, *args, **kwargs):
+
+        super().__init__(*args, **kwargs)
+        self._id_lock = threading.Lock()
+        self.server_quit = False
+
+    def run(self):
+        """Handles messages until the server quits, and then wakes up the
+        requests that are still waiting, because no response will arrive.
+        """
+
+        try:
+            super().run()
+        finally:
+            self.server_quit = True
+            for cond in list(self.event_dict.values()):
+                with cond:
+                    cond.notify()
+
+    def call_method(self, method_name, **kwargs):
+        """Sends a request and waits for the result. Raises a TimeoutError if
+        no response is received in time, and a ConnectionError if the server
+        quit.
+        """
+
+        with self._id_lock:
+            current_id = self.next_id
+            self.next_id += 1
+        cond = threading.Condition()
+        self.event_dict[current_id] = cond
+        with cond:
+            if self.server_quit:
+                self.event_dict.pop(current_id)
+                raise ConnectionError(
+                    '{} not sent because server quit'.format(method_name)
+                )
+            self.send_message(method_name, kwargs, current_id)
+            if self.shutdown_flag:
+                self.event_dict.pop(current_id)
+                return None
+            if not cond.wait(timeout=self._timeout):
+                self.event_dict.pop(current_id)
+                self.send_notification('$/cancelRequest', id=current_id)
+                raise TimeoutError(
+                    '{} (id={}) timed out'.format(method_name, current_id)
+                )
+        self.event_dict.pop(current_id)
+        if current_id not in self.response_dict:
+            raise ConnectionError(
+                '{} (id={}) failed because server quit'.format(
+                    method_name,
+                    current_id
+                )
+            )
+        result, error = self.response_dict.pop(current_id)
+        if error:
+            raise lsp_structs.ResponseError(
+                error.get('code'),
+                error.get('message'),
+                error.get('data')
+            )
+        return result
+
+    def handle_result(self, rpc_id, result, error):
+
+        cond = self.event_dict.get(rpc_id)
+        if cond is None:
+            return
+        with cond:
+            # The request may have timed out while we were waiting for the
+            # lock.
+            if rpc_id in self.event_dict:
+                self.response_dict[rpc_id] = result, error
+                cond.notify()
+
+
+def _write_all(fd, buffers):
+    """Writes a list of buffers to a file descriptor. A pipe may accept only
+    part of the data, in which case writev() is called again for the rest.
+    """
+
+    buffers = [memoryview(buffer) for buffer in buffers]
+    while buffers:
+        written = os.writev(fd, buffers[:IOV_MAX])
+        while buffers and written >= len(buffers[0]):
+            written -= len(buffers.pop(0))
+        if buffers:
+            buffers[0] = buffers[0][written:]
+
+
+def _message_size(headers):
+    """Returns the content length from a list of header lines."""
+    
+    message_size = None
+    for header in headers:
+        if header.lower().startswith(LEN_HEADER):
+            try:
+                message_size = int(header[len(LEN_HEADER):])
+            except ValueError:
+                raise lsp_structs.ResponseError(
+                    lsp_structs.ErrorCodes.ParseError,
+                    'Bad header: size is not int'
+                )
+    if message_size is None:
+        raise lsp_structs.ResponseError(
+            lsp_structs.ErrorCodes.ParseError,
+            'Bad header: missing size'
+        )
+    return message_size
+
+
+def _dumps(message):
+    """Serializes a message to UTF-8 encoded JSON. orjson is used when
+    available, because it is much faster than json for large messages, and
+    directly returns bytes.
+    """
+
+    if orjson is None:
+        return json.dumps(message, default=_to_dict).encode('utf-8')
+    return orjson.dumps(message, default=_to_dict)
+
+
+def _loads(body):
+    """Deserializes a UTF-8 encoded JSON message."""
+
+    if orjson is None:
+        return json.loads(body.decode('utf-8'))
+    return orjson.loads(body)
+
+
+def _to_dict(obj):
+    """Serializes the lsp_structs objects that are used as parameters."""
+
+    return obj.__dict__
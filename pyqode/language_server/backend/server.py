@@ -32,11 +32,18 @@ if __name__ == '__main__':
         default=[],
         help='A list of project folders'
     )
+    parser.add_argument(
+        '--cache-symbols',
+        action='store_true',
+        help='Store document symbols on disk, also for later sessions'
+    )
     args = parser.parse_args()
 
     from pyqode.core import backend
     from pyqode.language_server.backend import workers
 
+    if args.cache_symbols:
+        workers.SYMBOLS_DB_PATH = workers.DEFAULT_SYMBOLS_DB_PATH
     workers.start_language_server(args.command, args.project_folders)
     workers.langid = args.langid.lower()
     backend.CodeCompletionWorker.providers += [
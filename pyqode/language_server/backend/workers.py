@@ -4,17 +4,29 @@ Contains the worker classes/functions executed on the server side.
 """
 
 import os
+import sys
+import json
 import shlex
+import shutil
 import time
 import logging
 import subprocess
 import difflib
+import hashlib
+import sqlite3
 import tempfile
-from contextlib import contextmanager
-from pylspclient import JsonRpcEndpoint, LspEndpoint, LspClient, lsp_structs
+import itertools
+import functools
+import operator
+import threading
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager, nullcontext
+from pylspclient import LspClient, lsp_structs
 from pylspclient.lsp_structs import (
     TextDocumentItem,
+    TextDocumentIdentifier,
     Position,
+    Range,
     CompletionContext,
     CompletionTriggerKind,
     CompletionItemKind,
@@ -22,12 +34,29 @@ from pylspclient.lsp_structs import (
     VersionedTextDocumentIdentifier,
     TextDocumentContentChangeEvent,
 )
+from pyqode.language_server.backend.jsonrpc import (
+    BufferedEndpoint,
+    PipeEndpoint,
+    CancellingLspEndpoint
+)
+
+try:
+    from rapidfuzz import process as fuzzy_process, fuzz
+except ImportError:
+    fuzzy_process = None  # Fall back to difflib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Not available on Windows
 
 try:
     BrokenPipeError
 except NameError:
     BrokenPipeError = Exception  # For Python 2
 
+_log = logging.getLogger(__name__)
+
 WARNING = 1
 ERROR = 2
 ICON_PATH = ('path', ':/pyqode_python_icons/rc/path.png')
@@ -43,23 +72,135 @@ ICONS = {
     CompletionItemKind.Keyword: ICON_KEYWORD,
 }
 MAX_COMPLETIONS = 10  # Limit the number of completion suggestions
-RESPONSE_TIMEOUT = 10  # Restart server if no response is received after timeout
+COMPLETION_CACHE_SIZE = 128  # The number of completion lists to remember
+SYMBOLS_CACHE_SIZE = 32  # The number of symbol lists to remember
+SIGNATURES_CACHE_SIZE = 32  # The number of calltips to remember
+FRONTEND_CODE_SIZE = 64  # The number of frontend modes to remember code for
+TRUNCATION_MARKER = '\n\n[continues]'  # Appended to truncated documentation
+SYMBOLS_DB_SIZE = 1024  # The number of symbol lists to store on disk
+# The platform's directory for user-specific cache files
+if os.name == 'nt':
+    CACHE_DIR = os.environ.get('LOCALAPPDATA', os.path.expanduser('~'))
+elif sys.platform == 'darwin':
+    CACHE_DIR = os.path.join(os.path.expanduser('~'), 'Library', 'Caches')
+else:
+    CACHE_DIR = os.environ.get(
+        'XDG_CACHE_HOME',
+        os.path.join(os.path.expanduser('~'), '.cache')
+    )
+# Symbols can be stored on disk, so that they are available right away when a
+# document is opened again, also in a later session. The database contains
+# names from the user's code, so it is only used when SYMBOLS_DB_PATH is set,
+# for example to DEFAULT_SYMBOLS_DB_PATH (see the --cache-symbols option of the
+# server script).
+DEFAULT_SYMBOLS_DB_PATH = os.path.join(
+    CACHE_DIR,
+    'pyqode.language_server',
+    'symbols.sqlite'
+)
+SYMBOLS_DB_PATH = None
+# The capacity of the pipes to the server, so that the server and the client
+# can write large messages without blocking until the other side reads them.
+PIPE_SIZE = 1 << 20
+RESPONSE_TIMEOUT = 10  # Cancel requests that take longer than this
+MAX_TIMEOUTS = 3  # Restart server after this many consecutive timeouts
+# A server that quit is restarted right away the first time. After that, the
+# delay (in s) between restarts doubles up to a maximum, until a request
+# succeeds again.
+MIN_RESTART_DELAY = 1
+MAX_RESTART_DELAY = 60
+DIAGNOSTICS_WAIT = .1  # Wait this long for diagnostics when polling
+DIAGNOSTICS_WAIT_WINDOW = 1  # But only this long after the document was sent
+# Returned when a frontend mode sends an edit of code that the backend doesn't
+# know (anymore), in which case the mode should send the full code again.
+SOURCE_UNKNOWN = 'source unknown'
 SERVER_NOT_STARTED = 0
 SERVER_RUNNING = 1
 SERVER_ERROR = 2
-CLIENT_CAPABILITIES = {}  # For now go with defaults
+# Servers use the client capabilities to leave out things that the client
+# doesn't use, which keeps responses small.
+CLIENT_CAPABILITIES = {
+    'textDocument': {
+        'completion': {
+            'completionItem': {
+                'snippetSupport': False,
+                'labelDetailsSupport': False,
+                'documentationFormat': ['plaintext'],
+                # Documentation isn't shown, and this allows servers to leave
+                # it out of the completion list.
+                'resolveSupport': {'properties': ['documentation']}
+            }
+        },
+        'signatureHelp': {
+            'signatureInformation': {
+                'documentationFormat': ['plaintext']
+            }
+        },
+        'publishDiagnostics': {
+            'relatedInformation': False
+        }
+    }
+}
+URI_PREFIX = 'file://'
+SYNC_INCREMENTAL = 2  # TextDocumentSyncKind.Incremental
+BATCH_WRITES = True  # Write multiple notifications at once when possible
 
 client = None  # Set by start_language_server
 server_status = SERVER_NOT_STARTED
 server_capabilities = None
+incremental_sync = False  # Whether the server accepts incremental changes
+consecutive_timeouts = 0
+restart_delay = MIN_RESTART_DELAY
+last_restart = None  # The time of the last restart after the server quit
 langid = None
 server_process = None
 server_cmd = None
 project_folders = None
-diagnostics = {}  # Set by on_publish_diagnostics
-# Maintains opened documents as path => version mappings. The empty string is
-# used as the path for new (unsaved) documents.
-open_documents = {'': 0}
+# Maps uris to (hash, messages) tuples, where messages is a tuple of
+# (message, severity, line, (start, end)) tuples in the format that is
+# returned by poll_diagnostics(). Set by on_publish_diagnostics, and reset to
+# None when a document is sent to the server.
+diagnostics = {}
+# Notified by on_publish_diagnostics, so that poll_diagnostics() can wait for
+# diagnostics that are about to be published.
+diagnostics_published = threading.Condition()
+# Maps uris to ((hash, ignore_rules), messages) tuples, so that polling
+# unchanged diagnostics doesn't process them again.
+polled_diagnostics = {}
+# The state of documents on the server is keyed by uri, rather than by path,
+# because that's how the server identifies documents. All new (unsaved)
+# documents share the uri of a temporary file.
+#
+# The uris of documents that have been opened on the server.
+open_documents = set()
+# Maps uris to itertools.count() objects that provide the version numbers of
+# documents. A version is only taken when a message that requires one is sent.
+document_versions = defaultdict(itertools.count)
+# Maps uris to the code that was last sent to the server, so that unchanged
+# documents are not sent (and re-parsed) again, and so that changed documents
+# can be sent as incremental changes.
+sent_code = {}
+# Maps uris to the time at which the document was last sent to the server, so
+# that polling only waits for diagnostics that may be about to be published.
+sync_times = {}
+# Maps (path, line, column, digest) keys to (prefix, matches) tuples, where
+# column is the start of the prefix and digest is the digest of the code
+# without the prefix. Used as an LRU cache by CompletionProvider.
+completion_cache = OrderedDict()
+# Maps (path, digest, kinds) keys to symbol lists. Used as an LRU cache by
+# symbols().
+symbols_cache = OrderedDict()
+# Maps channels to (version, code) tuples, where code is the code that the
+# frontend mode identified by channel last sent. This allows modes to send
+# only the part of the code that changed. Used as an LRU cache by
+# _request_code(), because modes don't tell the backend when they are removed.
+frontend_code = OrderedDict()
+# The sqlite3 connection to SYMBOLS_DB_PATH. None until it is opened, and
+# False if it cannot be used.
+symbols_db = None
+# Maps (path, digest, line, column, include_docs) keys to calltips. Used as an
+# LRU cache by calltips().
+signatures_cache = OrderedDict()
 _, tmp_path = tempfile.mkstemp('pyqode.language_server')
 
 
@@ -67,34 +208,54 @@ def start_language_server(cmd, folders, shell=False):
     """Starts the language server and waits for initialization to complete."""
     
     global client, server_process, server_cmd, server_status, project_folders
-    global server_capabilities
+    global server_capabilities, incremental_sync
 
-    print('starting language server: "{}"'.format(cmd))
+    _log.info('starting language server: "%s"', cmd)
+    args = shlex.split(cmd)
+    if os.name != 'nt' and not shell and args:
+        # subprocess uses posix_spawn(), which is much cheaper than fork() for
+        # a large process such as this one, when the executable is specified
+        # as a path and file descriptors don't need to be closed. Python
+        # doesn't let child processes inherit its file descriptors anyway.
+        args[0] = shutil.which(args[0]) or args[0]
     try:
         server_process = subprocess.Popen(
-            shlex.split(cmd),
+            args,
             stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
+            # The PipeEndpoint reads from and writes to the file descriptors
+            # directly, so buffering would only allocate unused buffers.
+            bufsize=PIPE_SIZE if os.name == 'nt' else 0,
+            close_fds=os.name == 'nt',
             shell=shell
         )
     except FileNotFoundError as e:
-        print('failed to start language server: {}"'.format(e))
+        _log.warning('failed to start language server: %s', e)
         if not shell:
             # If the language server cannot be found, then perhaps trying 
             # through the shell works, because that way it can make use of
             # paths etc.
-            print('retrying through shell')
+            _log.info('retrying through shell')
             start_language_server(cmd, folders, shell=True)
             return
         server_status = SERVER_ERROR
         return
     server_status = SERVER_RUNNING
-    json_rpc_endpoint = JsonRpcEndpoint(
-        server_process.stdin,
-        server_process.stdout
-    )
-    endpoint = LspEndpoint(
+    _enlarge_pipe(server_process.stdin)
+    _enlarge_pipe(server_process.stdout)
+    if os.name == 'nt':
+        json_rpc_endpoint = BufferedEndpoint(
+            server_process.stdin,
+            server_process.stdout
+        )
+    else:
+        json_rpc_endpoint = PipeEndpoint(
+            server_process.stdin,
+            server_process.stdout,
+            server_process.stderr
+        )
+    endpoint = CancellingLspEndpoint(
         json_rpc_endpoint,
         notify_callbacks={
             'textDocument/publishDiagnostics': on_publish_diagnostics
@@ -114,27 +275,47 @@ def start_language_server(cmd, folders, shell=False):
             workspaceFolders=None if not project_folders else project_folders
         )
     except (lsp_structs.ResponseError, TimeoutError, BrokenPipeError) as e:
-        print('failed to initialize language server: {}'.format(e))
+        _log.warning('failed to initialize language server: %s', e)
         server_status = SERVER_ERROR
         return
     client.initialized()
+    # textDocumentSync is either a TextDocumentSyncKind or a dict with the
+    # kind stored under change.
+    sync = (server_capabilities or {}).get('capabilities', {}).get(
+        'textDocumentSync'
+    )
+    if isinstance(sync, dict):
+        sync = sync.get('change')
+    incremental_sync = sync == SYNC_INCREMENTAL
     server_cmd = cmd
-    print(server_capabilities)
-    print('project_folders {}'.format(project_folders))
-    print('language server started')
+    _log.debug(server_capabilities)
+    _log.debug('project_folders %s', project_folders)
+    _log.info('language server started')
 
 
 def restart_language_server():
     """Kills a running language server and restarts it."""
     
     global client, server_status
-    print('killing language server')
+    _log.info('killing language server')
     client = None
     server_process.kill()
     if not server_process.wait(timeout=5):
-        print('failed to kill language server')
+        _log.warning('failed to kill language server')
     server_status = SERVER_NOT_STARTED
+    # The new server doesn't know about any documents yet, so we open them
+    # again, all in one go.
+    documents = dict(sent_code)
+    open_documents.clear()
+    document_versions.clear()
+    sent_code.clear()
     start_language_server(server_cmd, project_folders)
+    if server_status != SERVER_RUNNING:
+        return
+    with _batched_writes():
+        # _path_to_uri() returns uris unchanged, so uris can be passed as paths
+        for uri, code in documents.items():
+            _sync_document(uri, code)
 
 
 def change_project_folders(request_data):
@@ -143,94 +324,236 @@ def change_project_folders(request_data):
     if server_status != SERVER_RUNNING:
         return
     folders = request_data['folders']
+    _path_to_uri.cache_clear()
     # Not implemented yet in pylsp
-    print('changing workspace folders: {}'.format(folders))
+    _log.info('changing workspace folders: %s', folders)
     
 
 def calltips(request_data):
     """Requests calltips (signatures) from the server."""
 
+    code = _request_code(request_data)
+    if code is None:
+        return SOURCE_UNKNOWN
     if server_status != SERVER_RUNNING:
         return ()
+    path = request_data['path']
     line = request_data['line']
     column = request_data['column']
-    logging.debug(request_data)
-    td = _text_document(**request_data)
-    # It appears that pyls returns an empty signature unless a didOpen is sent
-    # to the server. Therefore we first try to get signatures once, and then if
-    # this fails, try again but this time after sending a didOpen.
-    for attempt in range(2):
-        try:
-            signatures = _run_command(
-                'signatures(attempt={}, line={}, column={})'.format(
-                    attempt,
-                    line,
-                    column
-                ),
-                client.signatureHelp,
-                (td, Position(line, column))
-            )
-        except TypeError:
-            # The TypeScript server tends to give TypeErrors on the first try
-            print('signatures gave TypeError')
+    # Documentation can be long, and is left out if the client doesn't show it
+    include_docs = request_data.get('include_docs', True)
+    # Documentation can also be very long, and is then truncated here rather
+    # than in the client, so that it isn't sent to the client in full.
+    max_doc_length = request_data.get('max_doc_length', None)
+    _log.debug(request_data)
+    # Calltips are often requested again for the same position, for example
+    # after pressing backspace and typing the same character again.
+    key = path, _digest(code), line, column, include_docs, max_doc_length
+    if key in signatures_cache:
+        _log.debug('signatures from cache')
+        signatures_cache.move_to_end(key)
+        return signatures_cache[key]
+    # Signatures are based on the server's version of the document. Nothing is
+    # sent if the code didn't change since the last request. Otherwise, the
+    # change is written together with the request.
+    with _batched_writes():
+        _sync_document(path, code)
+        td = _document_identifier(path)
+        # It appears that the first signature request sometimes gives an
+        # empty signature. Therefore we first try to get signatures once, and
+        # then if this fails, try again but this time after sending the full
+        # code again.
+        for attempt in range(2):
+            try:
+                signatures = _run_command(
+                    'signatures(attempt={}, line={}, column={})'.format(
+                        attempt,
+                        line,
+                        column
+                    ),
+                    client.signatureHelp,
+                    (td, Position(line, column))
+                )
+            except TypeError:
+                # The TypeScript server tends to give TypeErrors on the first
+                # try
+                _log.debug('signatures gave TypeError')
+            else:
+                if signatures is not None and signatures.signatures:
+                    break
+            _sync_document(path, code, force=True)
         else:
-            if signatures is not None and signatures.signatures:
-                break
-        client.didChange(
-            _text_identifier(**request_data),
-            [_everything_changed(**request_data)]
-        )
-    else:
-        return ()
+            return ()
     signature = signatures.signatures[signatures.activeSignature]
     # Some servers give a documentation string directly, others a dict with a
     # value and a format.
-    if isinstance(signature.documentation, dict):
+    if not include_docs:
+        signature.documentation = ''
+    elif isinstance(signature.documentation, dict):
         if 'value' in signature.documentation:
             signature.documentation = signature.documentation['value']
         else:
             signature.documentation = ''
-    return (
+    if max_doc_length is not None and signature.documentation and \
+            len(signature.documentation) > max_doc_length:
+        signature.documentation = \
+            signature.documentation[:max_doc_length] + TRUNCATION_MARKER
+    ret_val = (
         signature.label,
         [p.label for p in signature.parameters],
         signature.documentation,
         signatures.activeParameter,
         column
     )
+    signatures_cache[key] = ret_val
+    if len(signatures_cache) > SIGNATURES_CACHE_SIZE:
+        signatures_cache.popitem(last=False)
+    return ret_val
+
+
+# Get the fields of a symbol that are returned by symbols() at once
+_symbol_fields = operator.attrgetter(
+    'name',
+    'kind.name',
+    'location.range.start.line',
+    'containerName'
+)
 
 
 def symbols(request_data):
     """Requests document symbols from the server."""
     
+    code = _request_code(request_data)
+    if code is None:
+        return SOURCE_UNKNOWN
     if server_status != SERVER_RUNNING:
         return []
-    symbol_kind = request_data['kind']
-    td = _text_document(**request_data)
-    symbols = _run_command(
-        'symbols',
-        client.documentSymbol,
-        (td,)
-    )
-    if symbols is None:
-        return []
-    return [
-        (s.name, s.kind.name, s.location.range.start.line, s.containerName)
-        for s in symbols
-        if s.kind.name in symbol_kind
-    ]
+    path = request_data['path']
+    # A frozenset is used as part of the cache key, and for fast filtering
+    symbol_kind = frozenset(request_data['kind'])
+    # The outline is often refreshed while the code hasn't changed
+    digest = _digest(code)
+    key = path, digest, symbol_kind
+    if key in symbols_cache:
+        _log.debug('symbols from cache')
+        symbols_cache.move_to_end(key)
+        return symbols_cache[key]
+    # All symbols are stored on disk, regardless of their kind
+    all_symbols = _load_symbols(path, digest)
+    if all_symbols is None:
+        # Symbols are based on the server's version of the document
+        with _batched_writes():
+            _sync_document(path, code)
+            td = _document_identifier(path)
+            symbols = _run_command(
+                'symbols',
+                client.documentSymbol,
+                (td,)
+            )
+        if symbols is None:
+            return []
+        all_symbols = [_symbol_fields(s) for s in symbols]
+        _store_symbols(path, digest, all_symbols)
+    ret_val = [s for s in all_symbols if s[1] in symbol_kind]
+    symbols_cache[key] = ret_val
+    if len(symbols_cache) > SYMBOLS_CACHE_SIZE:
+        symbols_cache.popitem(last=False)
+    return ret_val
+    
+    
+def _symbols_db():
+    """Returns the connection to the database in which symbols are stored,
+    or None if symbols cannot be stored.
+    """
     
+    global symbols_db
+    if symbols_db is None and SYMBOLS_DB_PATH:
+        try:
+            os.makedirs(os.path.dirname(SYMBOLS_DB_PATH), exist_ok=True)
+            symbols_db = sqlite3.connect(SYMBOLS_DB_PATH, timeout=1)
+            # The database is only a cache, so it's not worth waiting for the
+            # data to reach the disk. At worst, a power loss corrupts it, and
+            # symbols are then requested from the server again.
+            symbols_db.execute('PRAGMA journal_mode=WAL')
+            symbols_db.execute('PRAGMA synchronous=OFF')
+            symbols_db.execute(
+                'CREATE TABLE IF NOT EXISTS symbols ('
+                'server TEXT, path TEXT, digest BLOB, symbols TEXT, '
+                'PRIMARY KEY (server, path, digest))'
+            )
+        except (OSError, sqlite3.Error) as e:
+            _log.warning('failed to open symbols database: %s', e)
+            symbols_db = False
+    return symbols_db or None
+
+
+def _load_symbols(path, digest):
+    """Returns the symbols that were stored for a document, possibly during
+    an earlier session, or None if no symbols were stored. The symbols
+    depend on the server, which is therefore part of the key.
+    """
     
-class CompletionMatch(str):
-    """Allows a full completion item to be processed by difflib by behaving as
-    a string.
+    db = _symbols_db()
+    if db is None or not path:
+        return None
+    try:
+        row = db.execute(
+            'SELECT symbols FROM symbols '
+            'WHERE server = ? AND path = ? AND digest = ?',
+            (server_cmd, path, digest)
+        ).fetchone()
+    except sqlite3.Error as e:
+        _log.debug('failed to load symbols: %s', e)
+        return None
+    if row is None:
+        return None
+    _log.debug('symbols from database')
+    return [tuple(s) for s in json.loads(row[0])]
+
+
+def _store_symbols(path, digest, all_symbols):
+    """Stores the symbols of a document. Replacing a row gives it a new rowid,
+    so that the rows with the lowest rowids are the least recently stored
+    ones. These are removed when there are more than SYMBOLS_DB_SIZE rows.
+    The symbols are written right away, which is cheap because the database
+    doesn't wait for the data to reach the disk.
     """
     
-    tooltip = None
-    icon = None
+    db = _symbols_db()
+    if db is None or not path:
+        return
+    try:
+        with db:
+            db.execute(
+                'INSERT OR REPLACE INTO symbols VALUES (?, ?, ?, ?)',
+                (server_cmd, path, digest, json.dumps(all_symbols))
+            )
+            db.execute(
+                'DELETE FROM symbols '
+                'WHERE rowid <= (SELECT max(rowid) FROM symbols) - ?',
+                (SYMBOLS_DB_SIZE,)
+            )
+    except sqlite3.Error as e:
+        _log.debug('failed to store symbols: %s', e)
+
+
+class CompletionMatch:
+    """Remembers the tooltip and icon of a completion. Matching is done on the
+    text only, so this is a plain slotted object, rather than a str subclass
+    with an attribute dict for each of the many completions.
+    """
+    
+    __slots__ = ('text', 'icon', 'tooltip')
+    
+    def __init__(self, text, icon=None, tooltip=None):
+        
+        self.text = text
+        self.icon = icon
+        self.tooltip = tooltip
     
     def to_dict(self):
         
-        return {'name': self, 'icon': self.icon, 'tooltip': self.tooltip}
+        return {'name': self.text, 'icon': self.icon, 'tooltip': self.tooltip}
         
     @classmethod
     def from_completion(cls, completion):
@@ -240,10 +563,11 @@ class CompletionMatch(str):
         text = completion.insertText
         if not text:
             text = completion.label
-        completion_match = cls(text)
-        completion_match.icon = ICONS.get(completion.kind, ICON_VAR)
-        completion_match.tooltip = completion.detail
-        return completion_match
+        return cls(
+            text,
+            ICONS.get(completion.kind, ICON_VAR),
+            completion.detail
+        )
 
 
 class CompletionProvider:
@@ -267,8 +591,61 @@ class CompletionProvider:
         
         if server_status != SERVER_RUNNING:
             return []
-        column += len(prefix)  # Go to the cursor position
-        td = _text_document(path, code)
+        # The completions that the server gives don't depend on the prefix,
+        # except that the server may already filter them by the prefix. This
+        # means that, as long as the rest of the code stays the same and the
+        # user keeps extending the prefix, the completions from a previous
+        # request can be filtered again without asking the server.
+        key = (
+            path,
+            line,
+            column,
+            _digest(_remove_prefix(code, line, column, prefix))
+        )
+        cached = completion_cache.get(key)
+        if cached is not None and prefix.startswith(cached[0]):
+            _log.debug('completions from cache')
+            completion_cache.move_to_end(key)
+            possibilities = cached[1]
+        else:
+            completions = _request_completions(
+                code,
+                line,
+                column + len(prefix),  # Go to the cursor position
+                path,
+                triggered_by_symbol
+            )
+            if completions is None:
+                return []
+            possibilities, is_incomplete = completions
+            # Incomplete completion lists need to be requested again when the
+            # prefix changes, and are therefore not cached.
+            if not is_incomplete:
+                completion_cache[key] = prefix, possibilities
+                if len(completion_cache) > COMPLETION_CACHE_SIZE:
+                    completion_cache.popitem(last=False)
+        # We get the best matching completions, and then return these as a
+        # list of dicts.
+        matches = _best_matches(prefix, possibilities)
+        _log.debug('completions gave %d suggestions', len(matches))
+        return [match.to_dict() for match in matches]
+
+
+def _request_completions(code, line, column, path, triggered_by_symbol):
+    """Requests completions from the server. Returns a (matches,
+    is_incomplete) tuple, where matches is a dict that maps the text of each
+    completion to a CompletionMatch object, or None if no completions were
+    received.
+    """
+    
+    # Make sure that the server knows about all changes since the last
+    # request, so that completions are based on the current code. All
+    # keystrokes since the last sync are sent as a single didChange, and
+    # nothing is sent if the code didn't change. The didChange is written
+    # together with the request.
+    with _batched_writes():
+        _sync_document(path, code)
+        td = _document_identifier(path)
         # Similar to the calltips function, it appears that the first
         # completion request sometimes fails with a ResponseError. When this
         # happens, we send a didChange and try again. This appears to work.
@@ -293,43 +670,92 @@ class CompletionProvider:
                     )
                 )
             except lsp_structs.ResponseError:
-                print('completions gave ResponseError')
+                _log.debug('completions gave ResponseError')
             else:
                 if completions is not None:
                     break
-            client.didChange(
-                _text_identifier(path),
-                [_everything_changed(code)]
-            )
+            _sync_document(path, code, force=True)
         else:
-            return []
-        # It appears that the TypeScript server returns the items directly as
-        # a list, whereas other servers return the items as a property.
-        if hasattr(completions, 'items'):
-            completions = completions.items
-        # The CompletionMatch class behaves as a string, but also remembers
-        # the tooltip and icon of a completion. We use difflib to get the best
-        # matching completions, and then return these as a list of dicts.
-        matches = difflib.get_close_matches(
+            return None
+    # It appears that the TypeScript server returns the items directly as
+    # a list, whereas other servers return the items as a property.
+    is_incomplete = getattr(completions, 'isIncomplete', False)
+    if hasattr(completions, 'items'):
+        completions = completions.items
+    # Completions with the same text are shown only once.
+    matches = {}
+    for completion in completions:
+        match = CompletionMatch.from_completion(completion)
+        matches[match.text] = match
+    return matches, is_incomplete
+    
+    
+def _best_matches(prefix, possibilities):
+    """Returns the MAX_COMPLETIONS possibilities that best match the prefix.
+    The possibilities are a dict that maps texts to CompletionMatch objects.
+    rapidfuzz is used when available, because difflib is implemented in pure
+    Python and becomes slow when the server gives hundreds of completions.
+    """
+    
+    texts = list(possibilities)
+    if fuzzy_process is None:
+        best_texts = difflib.get_close_matches(
             prefix,
-            possibilities=set(
-                CompletionMatch.from_completion(completion)
-                for completion in completions
-            ),
+            possibilities=texts,
             n=MAX_COMPLETIONS,
             cutoff=0
         )
-        print('completions gave {} suggestions'.format(len(matches)))
-        return [match.to_dict() for match in matches]
-    
-    
+    else:
+        best_texts = [
+            text
+            for text, _, _ in fuzzy_process.extract(
+                prefix,
+                texts,
+                scorer=fuzz.WRatio,
+                limit=MAX_COMPLETIONS,
+                score_cutoff=0
+            )
+        ]
+    return [possibilities[text] for text in best_texts]
+
+
+# Get several fields from the diagnostics at once
+_message_and_range = operator.itemgetter('message', 'range')
+_start_and_end = operator.itemgetter('start', 'end')
+_line_and_character = operator.itemgetter('line', 'character')
+
+
 def on_publish_diagnostics(d):
     """Is called by the server when diagnostic info is available."""
     
-    msg = d.get('diagnostics', [])
     uri = d.get('uri', None)
-    print('publishing diagnostic {} messages for {}'.format(len(msg), uri))
-    diagnostics[uri] = d
+    # The messages are converted to the format that is returned by
+    # poll_diagnostics() right away, so that polling only needs to filter
+    # them. This also allows the rest of the (sometimes large) payload to be
+    # freed.
+    messages = []
+    for msg in d.get('diagnostics', []):
+        message, msg_range = _message_and_range(msg)
+        start, end = _start_and_end(msg_range)
+        line, start_character = _line_and_character(start)
+        severity = msg.get('severity', DiagnosticSeverity.Error)
+        messages.append((
+            message,
+            ERROR if severity <= DiagnosticSeverity.Error else WARNING,
+            line,
+            (start_character, end['character'])
+        ))
+    messages = tuple(messages)
+    _log.debug(
+        'publishing diagnostic %d messages for %s',
+        len(messages),
+        uri
+    )
+    # The hash is based on the messages only, because other fields, such as
+    # the version, change even when the messages don't.
+    with diagnostics_published:
+        diagnostics[uri] = hash(messages), messages
+        diagnostics_published.notify_all()
 
 
 def run_diagnostics(request_data):
@@ -339,24 +765,28 @@ def run_diagnostics(request_data):
     diagnostics from blocking the server.
     """
     
-    global diagnostics
-    if server_status != SERVER_RUNNING:
+    if server_status == SERVER_RUNNING and _server_quit():
+        _log.warning('diagnostics not run because server quit')
+        _restart_quit_server()
+    if server_status == SERVER_RUNNING and not _server_quit():
+        # If the code didn't change since the last sync, the diagnostics that
+        # were previously published are still valid.
+        try:
+            _sync_document(request_data['path'], request_data['code'])
+        except ConnectionError as e:
+            # The document is sent directly rather than through
+            # _run_command(), so a server that quit while it was sent gives a
+            # BrokenPipeError here.
+            _log.warning('diagnostics gave %s: %s', type(e).__name__, e)
+            _restart_quit_server()
+    if server_status != SERVER_RUNNING or _server_quit():
+        # A server that quit and hasn't been restarted yet is reported as an
+        # error
         return {
-            'server_status': server_status,
+            'server_status': SERVER_ERROR if _server_quit() else server_status,
             'server_pid': None,
             'server_capabilities': {}
         }
-    path = request_data['path']
-    print('opening  {}'.format(path))
-    diagnostics[_path_to_uri(path)] = {}  # reset diagnostics for this file
-    if path in open_documents:
-        client.didChange(
-            _text_identifier(**request_data),
-            [_everything_changed(**request_data)]
-        )
-    else:
-        open_documents[path] = 0
-        client.didOpen(_text_document(**request_data))
     return {
         'server_status': server_status,
         'server_pid': server_process.pid,
@@ -368,27 +798,39 @@ def poll_diagnostics(request_data):
     """Returns diagnostic messages if they are available."""
     
     uri = _path_to_uri(request_data['path'])
-    d = diagnostics.get(uri)
-    if not d:
-        return [None]
-    ignore_rules = request_data['ignore_rules']
-    ret_val = []
-    for msg in d.get('diagnostics', []):
-        if any(msg['message'].startswith(ir) for ir in ignore_rules):
-            continue
-        ret_val.append((
-            msg['message'],
-            ERROR if msg['severity'] <= DiagnosticSeverity.Error else WARNING,
-            msg['range']['start']['line'],
-            (
-                msg['range']['start']['character'],
-                msg['range']['end']['character']
+    # Servers often publish diagnostics shortly after a change. Waiting for a
+    # moment avoids another round-trip from the client, but the wait is kept
+    # short, because the backend doesn't handle other requests meanwhile. Long
+    # after a change, for example if the server doesn't publish diagnostics
+    # for this document at all, waiting would only delay other requests.
+    with diagnostics_published:
+        sync_time = sync_times.get(uri)
+        if sync_time is not None and \
+                time.monotonic() - sync_time < DIAGNOSTICS_WAIT_WINDOW:
+            diagnostics_published.wait_for(
+                lambda: diagnostics.get(uri) is not None,
+                timeout=DIAGNOSTICS_WAIT
             )
-        ))
-    print('polling {} diagnostic messages for {}'.format(
+        d = diagnostics.get(uri)
+    if d is None:
+        return [None]
+    diagnostics_hash, messages = d
+    # str.startswith() accepts a tuple of prefixes and checks them all in C
+    ignore_rules = _ignore_prefixes(tuple(request_data['ignore_rules']))
+    key = diagnostics_hash, ignore_rules
+    polled = polled_diagnostics.get(uri)
+    if polled is not None and polled[0] == key:
+        return polled[1]
+    ret_val = [
+        message for message in messages
+        if not message[0].startswith(ignore_rules)
+    ]
+    _log.debug(
+        'polling %d diagnostic messages for %s',
         len(ret_val),
-        format(uri))
+        uri
     )
+    polled_diagnostics[uri] = key, ret_val
     return ret_val
 
 
@@ -397,37 +839,156 @@ def close_document(request_data):
     in the client.
     """
 
+    path = request_data['path']
     if server_status != SERVER_RUNNING:
         return
-    path = request_data['path']
-    if path in open_documents:
-        del open_documents[path]
+    uri = _path_to_uri(path)
+    # The temporary uri may still be used by other new documents
+    if uri != URI_PREFIX + tmp_path:
+        open_documents.discard(uri)
+        document_versions.pop(uri, None)
+        sent_code.pop(uri, None)
+        sync_times.pop(uri, None)
+    for cache in (completion_cache, symbols_cache, signatures_cache):
+        for key in [key for key in cache if key[0] == path]:
+            del cache[key]
+    polled_diagnostics.pop(uri, None)
+    # The file may have been created or deleted since it was opened
+    _path_to_uri.cache_clear()
     # Not implemented yet in pylsp
-    # client.didClose(_text_document(**request_data))
+    # client.didClose(_document_identifier(path))
     
 
-def _text_document(path=None, code=None, **kwargs):
-    """Constructs a TextDocumentItem."""
+def _request_code(request_data):
+    """Returns the code of a request. The request either contains the full
+    code, or an edit of the code that was last sent through the same channel.
+    Returns None if the edit refers to a version of the code that is unknown,
+    for example because the backend was restarted.
+    """
+    
+    # Each mode has its own channel, and edits are relative to the code that
+    # the mode sent before, even if that was for a different path.
+    channel = request_data.get('channel')
+    if 'code' in request_data:
+        code = request_data['code']
+    else:
+        version, previous_code = frontend_code.get(channel, (None, None))
+        if version is None or version != request_data['base_version']:
+            return None
+        start, end, text = request_data['edit']
+        code = previous_code[:start] + text + previous_code[end:]
+        if len(code) != request_data['length']:
+            return None
+    if 'version' in request_data:
+        frontend_code[channel] = request_data['version'], code
+        frontend_code.move_to_end(channel)
+        if len(frontend_code) > FRONTEND_CODE_SIZE:
+            frontend_code.popitem(last=False)
+    return code
+
+
+@functools.lru_cache(16)
+def _ignore_prefixes(ignore_rules):
+    """Returns the smallest tuple of prefixes that ignores the same messages
+    as ignore_rules. Duplicate rules are removed, as are rules that start with
+    another rule, because these never ignore anything extra.
+    """
+    
+    prefixes = []
+    # After sorting, rules that start with another rule directly follow that
+    # rule (or other rules that start with it).
+    for rule in sorted(set(ignore_rules)):
+        if prefixes and rule.startswith(prefixes[-1]):
+            continue
+        prefixes.append(rule)
+    return tuple(prefixes)
+
+
+def _sync_document(path, code, force=False):
+    """Sends a didOpen or didChange to the server, unless the code is
+    identical to what was last sent for this path. If force is True, the full
+    code is sent again in any case. Returns True if the document was sent and
+    False otherwise.
+    """
     
     if not code.endswith('\n'):
         code += '\n'
-    open_documents[path] += 1
+    # Several paths may map to the same uri, and the code that was last sent
+    # for that uri is what the server has.
+    uri = _path_to_uri(path)
+    previous_code = sent_code.get(uri)
+    if previous_code == code and not force:
+        return False
+    # Reset diagnostics for this file before sending, because the server may
+    # publish new diagnostics before the call returns.
+    diagnostics[uri] = None
+    sync_times[uri] = time.monotonic()
+    if uri in open_documents:
+        _log.debug('changing %s', path)
+        client.didChange(
+            _text_identifier(uri),
+            [
+                _incremental_change(previous_code, code)
+                if incremental_sync and previous_code is not None
+                and not force
+                else _everything_changed(code)
+            ]
+        )
+    else:
+        _log.debug('opening %s', path)
+        open_documents.add(uri)
+        client.didOpen(_text_document(uri, code))
+    sent_code[uri] = code
+    return True
+
+
+def _batched_writes():
+    """Returns a context manager in which notifications are written to the
+    server at once, if this is supported by the endpoint.
+    """
+    
+    endpoint = client.lsp_endpoint.json_rpc_endpoint
+    if not BATCH_WRITES or not hasattr(endpoint, 'batch'):
+        return nullcontext()
+    return endpoint.batch()
+
+
+def _text_document(uri, code):
+    """Constructs a TextDocumentItem, which contains the full code and is only
+    needed to open a document.
+    """
+    
     return TextDocumentItem(
-        _path_to_uri(path),
+        uri,
         langid,
-        open_documents[path],
-        code
+        next(document_versions[uri]),
+        code if code.endswith('\n') else code + '\n'
     )
     
     
-def _text_identifier(path=None, **kwargs):
+def _document_identifier(path=None, **kwargs):
+    """Returns a TextDocumentIdentifier, which is all that requests need to
+    refer to a document that was synced before. Unlike a TextDocumentItem, it
+    doesn't contain the code, which would otherwise be sent with each request.
+    """
+    
+    return _uri_identifier(_path_to_uri(path))
+
+
+@functools.lru_cache(1024)
+def _uri_identifier(uri):
+    """Identifiers only contain the uri, so a single identifier is shared by
+    all requests for a document. The cache is keyed by uri, rather than by
+    path, so that it remains valid when paths are mapped to other uris.
+    """
+    
+    return TextDocumentIdentifier(uri)
+    
+    
+def _text_identifier(uri):
     """Constructs a VersionedTextDocumentIdentifier."""
     
-    open_documents[path] += 1
-    return VersionedTextDocumentIdentifier(
-        'file://' + path,
-        open_documents[path]
-    )
+    return VersionedTextDocumentIdentifier(uri, next(document_versions[uri]))
     
     
 def _everything_changed(code=None, **kwargs):
@@ -435,47 +996,215 @@ def _everything_changed(code=None, **kwargs):
     entire file being changed.
     """
     
-    if not code.endswith('\n'):
-        code += '\n'
-    return TextDocumentContentChangeEvent(None, None, code)
+    return TextDocumentContentChangeEvent(
+        None,
+        None,
+        code if code.endswith('\n') else code + '\n'
+    )
+
+
+def _incremental_change(old_code, new_code):
+    """Constructs a TextDocumentContentChangeEvent that only contains the part
+    of the code that changed, so that the server doesn't need to process the
+    entire file. Falls back to _everything_changed() when most of the code
+    changed.
+    """
+    
+    start, old_end, new_end = changed_span(old_code, new_code)
+    if 2 * (new_end - start) > len(new_code):
+        return _everything_changed(new_code)
+    removed = old_code[start:old_end]
+    return TextDocumentContentChangeEvent(
+        Range(
+            _position(old_code, start),
+            _position(old_code, old_end)
+        ),
+        _utf16_length(removed),
+        new_code[start:new_end]
+    )
+
+
+def changed_span(old_code, new_code):
+    """Returns a (start, old_end, new_end) tuple, such that new_code is
+    old_code with old_code[start:old_end] replaced by new_code[start:new_end].
+    This is also used by the frontend modes to send only the part of the code
+    that changed.
+    """
+    
+    start = _common_prefix_length(old_code, new_code)
+    # The common suffix may not overlap with the common prefix
+    max_suffix = min(len(old_code), len(new_code)) - start
+    suffix = _common_prefix_length(
+        old_code[len(old_code) - max_suffix:][::-1],
+        new_code[len(new_code) - max_suffix:][::-1]
+    )
+    return start, len(old_code) - suffix, len(new_code) - suffix
+
+
+def _common_prefix_length(a, b):
+    """Returns the length of the common prefix of two strings. This uses a
+    binary search with slice comparisons, which are implemented in C, instead
+    of comparing characters one by one in Python.
+    """
+    
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[lo:mid] == b[lo:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def _position(code, offset):
+    """Converts an offset in the code to a Position. Characters are counted
+    in UTF-16 code units, as required by the protocol.
+    """
+    
+    line_start = code.rfind('\n', 0, offset) + 1
+    return Position(
+        code.count('\n', 0, line_start),
+        _utf16_length(code[line_start:offset])
+    )
+
+
+def _utf16_length(text):
+    """Returns the length of a string in UTF-16 code units."""
+    
+    if text.isascii():
+        return len(text)
+    return len(text.encode('utf-16-le')) // 2
+
+
+def _remove_prefix(code, line, column, prefix):
+    """Returns the code with the prefix removed from the given position."""
+    
+    lines = code.split('\n')
+    try:
+        text = lines[line]
+    except IndexError:
+        return code
+    lines[line] = text[:column] + text[column + len(prefix):]
+    return '\n'.join(lines)
+
+
+def _digest(code):
+    """Returns a short digest of the code, which is used to check whether a
+    document changed.
+    """
+    
+    return hashlib.blake2b(code.encode('utf-8'), digest_size=8).digest()
 
 
-@contextmanager
 def _timer(msg):
     """A basic context manager to check the timing of functions. Mostly
-    useful for debugging and improving performance.
+    useful for debugging and improving performance. Nothing is timed unless
+    debug messages are logged.
     """
     
-    print('starting {}'.format(msg))
+    if not _log.isEnabledFor(logging.DEBUG):
+        return nullcontext()
+    return _timed(msg)
+
+
+@contextmanager
+def _timed(msg):
+    """Logs how long the context took."""
+    
+    _log.debug('starting %s', msg)
     t0 = time.time()
     yield
     t1 = time.time()
-    print('{} ({:.0f} ms)'.format(msg, 1000 * (t1 - t0)))
+    _log.debug('%s (%.0f ms)', msg, 1000 * (t1 - t0))
 
 
 def _run_command(name, fnc, args):
     """Sends a command to the server and returns the response. If a
     ResponseError occurs, None is returned. If a TimeoutError occurs, None is
-    also returned, and the server is restarted (because it may be hanging).
+    also returned, and the request is cancelled. The server is only restarted
+    (because it may be hanging) after several consecutive timeouts, because
+    restarting throws away everything that the server has cached. If the
+    server quit, it is restarted right away.
     """
     
+    global consecutive_timeouts, restart_delay, last_restart
     if server_status != SERVER_RUNNING:
-        print('{} not performed because server not running'.format(name))
+        _log.debug('%s not performed because server not running', name)
+    # If the server quit, there's no point in waiting for a response
+    if _server_quit():
+        _log.warning('%s not performed because server quit', name)
+        _restart_quit_server()
+        return None
     with _timer(name):
         try:
             ret_val = fnc(*args)
         except lsp_structs.ResponseError as e:
-            print('{}() gave ResponseError'.format(name))
-            print(str(e))
+            _log.debug('%s() gave ResponseError: %s', name, e)
+            ret_val = None
+        except ConnectionError as e:
+            # The server quit while the request was sent or waited for
+            _log.warning('%s() gave ConnectionError: %s', name, e)
+            _restart_quit_server()
             ret_val = None
         except TimeoutError:
-            print('{}() gave TimeoutError'.format(name))
-            restart_language_server()
+            _log.warning('%s() gave TimeoutError', name)
+            consecutive_timeouts += 1
+            if consecutive_timeouts >= MAX_TIMEOUTS:
+                consecutive_timeouts = 0
+                restart_language_server()
             ret_val = None
+        else:
+            consecutive_timeouts = 0
+            restart_delay = MIN_RESTART_DELAY
+            last_restart = None
     return ret_val
 
 
-def _folders_to_uris(paths, prefix='file://'):
+def _server_quit():
+    """Returns True if the server process was started but has quit."""
+    
+    return server_process is not None and server_process.poll() is not None
+
+
+def _restart_quit_server():
+    """Restarts a server that quit, unless it was restarted too recently. This
+    way a server that keeps quitting, for example while the open documents are
+    sent to it again, isn't restarted for every request.
+    """
+    
+    global restart_delay, last_restart
+    now = time.monotonic()
+    if last_restart is not None:
+        if now - last_restart < restart_delay:
+            _log.debug('not restarting server yet')
+            return
+        restart_delay = min(2 * restart_delay, MAX_RESTART_DELAY)
+    last_restart = now
+    restart_language_server()
+
+
+def _enlarge_pipe(f):
+    """Increases the capacity of a pipe to PIPE_SIZE on Linux. By default a
+    pipe holds 64 KiB, which means that a process that writes a large message
+    blocks until the other side has read most of it. The number of reads
+    doesn't change, because the endpoint reads at most READ_SIZE bytes at
+    once.
+    """
+    
+    if fcntl is None or not sys.platform.startswith('linux'):
+        return
+    try:
+        fcntl.fcntl(
+            f.fileno(),
+            getattr(fcntl, 'F_SETPIPE_SZ', 1031),  # Python >= 3.10
+            PIPE_SIZE
+        )
+    except OSError as e:
+        _log.debug('failed to enlarge pipe: %s', e)
+
+
+def _folders_to_uris(paths, prefix=URI_PREFIX):
     """Turns a list of paths or uris into a list of uris."""
     
     return [
@@ -484,13 +1213,15 @@ def _folders_to_uris(paths, prefix='file://'):
     ]
 
 
+@functools.lru_cache(maxsize=1024)
 def _path_to_uri(path):
     """Translates a path to a uri, falling back to a temporary file if the path
-    does not exist.
+    does not exist. The result is cached, because this is called for every
+    message and otherwise requires a stat() call.
     """
     
-    if path.startswith('file://'):
+    if path.startswith(URI_PREFIX):
         return path
     if os.path.exists(path):
-        return 'file://' + path
-    return 'file://' + tmp_path
+        return URI_PREFIX + path
+    return URI_PREFIX + tmp_path
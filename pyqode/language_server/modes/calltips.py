@@ -2,37 +2,148 @@
 """
 Gets calltips from the language server
 """
+import time
 from qtpy.QtWidgets import QToolTip
-from qtpy.QtCore import QObject, Qt, Signal
+from qtpy.QtCore import QObject, Qt, Signal, QTimer
 from pyqode.core.modes import CalltipsMode as CoreCalltipsMode
 from pyqode.language_server.backend import workers
 from pyqode.language_server.modes import LanguageServerMode
+from pyqode.language_server.modes.language_server_mode import REQUEST_TIMEOUT
+
+
+DEBOUNCE_DELAY = 20  # Only request calltips after a pause of this many ms
+MAX_DOC_LENGTH = 2000  # Documentation is truncated to this many characters
+# The keys for which pyqode.core hides the calltip
+HIDE_KEYS = (
+    Qt.Key_ParenRight,
+    Qt.Key_Return,
+    Qt.Key_Left,
+    Qt.Key_Right,
+    Qt.Key_Up,
+    Qt.Key_Down,
+    Qt.Key_End,
+    Qt.Key_Home,
+    Qt.Key_PageDown,
+    Qt.Key_PageUp,
+    Qt.Key_Backspace,
+    Qt.Key_Delete
+)
 
 
 class CalltipsMode(LanguageServerMode, CoreCalltipsMode):
     
-    def __init__(self):
+    def __init__(self, include_docs=True, max_doc_length=MAX_DOC_LENGTH):
+        """The include_docs keyword determines whether documentation is
+        requested. The calltips of pyqode.core don't show documentation, so
+        it can be left out if a subclass doesn't show it either. Longer
+        documentation is truncated to max_doc_length characters by the
+        backend, unless max_doc_length is None.
+        """
+        
         LanguageServerMode.__init__(self)
         CoreCalltipsMode.__init__(self)
-        self._working = False
+        self._include_docs = include_docs
+        self._max_doc_length = max_doc_length
+        # Each request has a sequence number, so that results of requests
+        # that have been superseded by a later request can be ignored.
+        self._request_seq = 0
+        self._pending_request = None
+        # At most one request is in flight. Requests that are made in the
+        # meantime replace the pending request, which is sent when the
+        # in-flight request finishes.
+        self._inflight_seq = None
+        self._inflight_time = 0
+        self._debounce_timer = QTimer()
+        self._debounce_timer.setSingleShot(True)
+        self._debounce_timer.setInterval(DEBOUNCE_DELAY)
+        self._debounce_timer.timeout.connect(self._send_pending_request)
+        # Sends the pending request if the results of the in-flight request
+        # don't arrive in time
+        self._lost_request_timer = QTimer()
+        self._lost_request_timer.setSingleShot(True)
+        self._lost_request_timer.timeout.connect(self._send_pending_request)
+
+    def on_state_changed(self, state):
+        
+        super().on_state_changed(state)
+        if not state:
+            self._drop_requests()
+
+    def _on_key_released(self, event):
+        
+        super()._on_key_released(event)
+        # A calltip that arrives after it was hidden should not be shown
+        if event.key() in HIDE_KEYS:
+            self._drop_requests()
+
+    def _drop_requests(self):
+        """Drops the pending request, and makes sure that the results of the
+        in-flight request are ignored.
+        """
+        
+        self._debounce_timer.stop()
+        self._lost_request_timer.stop()
+        self._pending_request = None
+        self._request_seq += 1
+        self._inflight_seq = None
 
     def _request_calltip(self, source, line, col, path, encoding):
-        if self._working:
+        # Calltips are requested on every ( and , keystroke. When typing
+        # quickly, only the last request of a burst is sent to the backend.
+        self._request_seq += 1
+        self._pending_request = self._request_seq, source, line, col, path
+        self._debounce_timer.start()
+        
+    def _send_pending_request(self):
+        if self._pending_request is None or self._debounce_timer.isActive():
             return
-        self._working = True
+        # A request that didn't finish in time is considered lost
+        if self._inflight_seq is not None:
+            remaining = REQUEST_TIMEOUT - (
+                time.monotonic() - self._inflight_time
+            )
+            if remaining > 0:
+                self._lost_request_timer.start(int(1000 * remaining) + 1)
+                return
+        request, self._pending_request = self._pending_request, None
+        self._send_request(*request)
+        
+    def _send_request(self, seq, source, line, col, path):
+        # The source is converted to request data only when the request is
+        # actually sent, because only the changes since the previously sent
+        # source are included.
+        self._inflight_seq = seq
+        self._inflight_time = time.monotonic()
+        request_data = self._source_request_data(source, path)
+        request_data.update({
+            'line': line,
+            'column': col,
+            'include_docs': self._include_docs,
+            'max_doc_length': self._max_doc_length,
+        })
         self.editor.backend.send_request(
             workers.calltips,
-            {
-                'code': source,
-                'line': line,
-                'column': col,
-                'path': path,
-            },
-            on_receive=self._on_results_available
+            request_data,
+            on_receive=lambda results: self._on_results_available(
+                results,
+                seq,
+                (seq, source, line, col, path)
+            )
         )
     
-    def _on_results_available(self, results):
-        self._working = False
+    def _on_results_available(self, results, seq=None, request=None):
+        if seq is not None and seq == self._inflight_seq:
+            self._inflight_seq = None
+        # Results that arrive after a new calltip was requested are outdated
+        if seq is not None and seq != self._request_seq:
+            self._send_pending_request()
+            return
+        # The backend didn't know the source that the changes were based on
+        if results == workers.SOURCE_UNKNOWN:
+            self._forget_source()
+            if request is not None:
+                self._send_request(*request)
+            return
         if not results:
             return
         call = {
@@ -9,6 +9,11 @@ from pyqode.language_server.backend.workers import (
     poll_diagnostics
 )
 
+# While no diagnostics are available, polling is retried after a delay that
+# starts short and doubles after each retry, up to a maximum (in ms).
+MIN_POLL_DELAY = 100
+MAX_POLL_DELAY = 2000
+
 
 class DiagnosticsMode(CheckerMode):
     
@@ -22,13 +27,16 @@ class DiagnosticsMode(CheckerMode):
         
         self._last_server_status = None
         self._show_diagnostics = show_diagnostics
+        self._poll_delay = MIN_POLL_DELAY
         super().__init__(run_diagnostics, delay=1000)
 
     def _on_poll_result(self, results):
         
         if len(results) == 1 and results[0] is None:
-            QTimer.singleShot(250, self._poll_messages)
+            QTimer.singleShot(self._poll_delay, self._poll_messages)
+            self._poll_delay = min(2 * self._poll_delay, MAX_POLL_DELAY)
             return
+        self._poll_delay = MIN_POLL_DELAY
         super()._on_work_finished(results)
         
     def _poll_messages(self):
@@ -56,8 +64,11 @@ class DiagnosticsMode(CheckerMode):
             )
             self._set_completion_triggers(results['server_capabilities'])
             self._last_server_status = results['server_status']
+        # The backend briefly waits for diagnostics to be published, so we
+        # can poll right away.
         if self._show_diagnostics:
-            QTimer.singleShot(250, self._poll_messages)
+            self._poll_delay = MIN_POLL_DELAY
+            self._poll_messages()
 
     def _set_completion_triggers(self, capabilities):
         """If CodeCompletionMode is enabled, set the trigger symbols to the
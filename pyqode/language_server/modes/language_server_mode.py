@@ -2,8 +2,9 @@
 """
 A base class for language-server modes.
 """
-import time
+import warnings
 from pyqode.core.api import Mode
+from pyqode.language_server.backend import workers
 from qtpy import QtCore
 
 
@@ -11,24 +12,92 @@ REQUEST_TIMEOUT = 5
 
 
 class LanguageServerMode(Mode):
+    
+    # The source code that was last sent to the backend, and its version
+    _sent_source = None
+    _source_version = 0
+    # The results of the last request(), or None if they didn't arrive in
+    # time. Deprecated: use the return value of request() instead.
+    _results = None
 
     def request(self, worker, request_data):
+        """Sends a request to the backend and returns the results, or an empty
+        list if no results arrive in time. Rather than polling, this waits in
+        a local event loop, which keeps the editor responsive without using
+        the CPU while waiting.
+        """
+        
+        results = []
+        loop = QtCore.QEventLoop()
+        timer = QtCore.QTimer()
+        timer.setSingleShot(True)
+        timer.timeout.connect(loop.quit)
+
+        def on_receive(response):
+            results.append(response)
+            loop.quit()
+
+        self.request_async(worker, request_data, on_receive)
+        if not results:
+            timer.start(REQUEST_TIMEOUT * 1000)
+            loop.exec_()
+            timer.stop()
+        self._results = results[0] if results else None
+        return results[0] if results else []
+        
+    def request_async(self, worker, request_data, callback):
+        """Sends a request to the backend without waiting for the results. The
+        callback is called with the results when they arrive.
+        """
         
-        self._results = None
         self.editor.backend.send_request(
             worker,
             request_data,
-            on_receive=self._on_results_available
+            on_receive=callback
         )
-        start_time = time.time()
-        while time.time() - start_time < REQUEST_TIMEOUT:
-            if self._results is not None:
-                break
-            QtCore.QCoreApplication.processEvents()
-        else:
-            return []
-        return self._results
         
     def _on_results_available(self, results):
+        """Deprecated: pass a callback to request_async() instead. Stores the
+        results in _results, as the callback of the polling request() did.
+        """
+        
+        warnings.warn(
+            '_on_results_available() is deprecated, use request_async()',
+            DeprecationWarning,
+            stacklevel=2
+        )
+        self._results = results
+        
+    def _source_request_data(self, source, path):
+        """Returns the request data that describes the source code. The full
+        code is only sent with the first request. After that, only the part
+        that changed since the previous request is sent, and the backend
+        applies this edit to its copy of the previously sent code.
+        """
+        
+        previous_source, self._sent_source = self._sent_source, source
+        self._source_version += 1
+        # The backend is shared by all editors, and the same path may be open
+        # in several editors, so each mode instance has its own channel.
+        request_data = {
+            'path': path,
+            'channel': '%s-%d' % (self.name, id(self)),
+            'version': self._source_version
+        }
+        if previous_source is None:
+            request_data['code'] = source
+            return request_data
+        start, old_end, new_end = workers.changed_span(previous_source, source)
+        request_data['base_version'] = self._source_version - 1
+        request_data['edit'] = start, old_end, source[start:new_end]
+        # Allows the backend to check that the edit was applied to the right
+        # code
+        request_data['length'] = len(source)
+        return request_data
+        
+    def _forget_source(self):
+        """Makes sure that the full code is sent with the next request, for
+        example because the backend doesn't know the previously sent code.
+        """
         
-        self._results = results
\ No newline at end of file
+        self._sent_source = None
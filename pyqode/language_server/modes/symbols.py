@@ -11,15 +11,89 @@ class SymbolsMode(LanguageServerMode):
     def __init__(self, symbols_kind):
         
         super().__init__()
-        self._symbols_kind = symbols_kind
+        # The kinds are converted once, rather than for each request, and a
+        # tuple cannot be changed afterwards by the caller.
+        self._symbols_kind = tuple(symbols_kind)
+        # The text version is increased whenever the text changes, so that the
+        # symbols can be reused for as long as the text stays the same.
+        self._text_version = 0
+        self._cached_symbols = None
+        
+    def on_state_changed(self, state):
+        
+        super().on_state_changed(state)
+        if state:
+            self.editor.textChanged.connect(self._on_text_changed)
+        else:
+            self.editor.textChanged.disconnect(self._on_text_changed)
+            
+    def _on_text_changed(self):
+        
+        self._text_version += 1
 
-    def request_symbols(self):
+    def request_symbols(self, callback=None):
+        """Requests the symbols of the current text. If a callback is given,
+        the request is sent without waiting, and the symbols are passed to the
+        callback when they arrive. Otherwise, the symbols are returned, which
+        means that the editor waits for them.
+        """
         
-        return self.request(
+        key = self._text_version, self.editor.file.path
+        if self._cached_symbols is not None and \
+                self._cached_symbols[0] == key:
+            if callback is None:
+                return self._cached_symbols[1]
+            callback(self._cached_symbols[1])
+            return
+        # toPlainText() already replaces paragraph separators by newlines
+        source = self.editor.toPlainText()
+        if callback is None:
+            symbols = self.request(
+                workers.symbols,
+                self._symbols_request_data(source)
+            )
+            if symbols == workers.SOURCE_UNKNOWN:
+                self._forget_source()
+                symbols = self.request(
+                    workers.symbols,
+                    self._symbols_request_data(source)
+                )
+            return self._on_symbols_available(key, symbols)
+
+        def on_receive(symbols):
+            if symbols != workers.SOURCE_UNKNOWN:
+                callback(self._on_symbols_available(key, symbols))
+                return
+            self._forget_source()
+            self.request_async(
+                workers.symbols,
+                self._symbols_request_data(source),
+                lambda symbols: callback(
+                    self._on_symbols_available(key, symbols)
+                )
+            )
+
+        self.request_async(
             workers.symbols,
-            {
-                'code': self.editor.toPlainText().replace(u'\u2029', u'\n'),
-                'path': self.editor.file.path,
-                'kind': self._symbols_kind
-            }
+            self._symbols_request_data(source),
+            on_receive
         )
+            
+    def _symbols_request_data(self, source):
+        
+        request_data = self._source_request_data(
+            source,
+            self.editor.file.path
+        )
+        request_data['kind'] = self._symbols_kind
+        return request_data
+    
+    def _on_symbols_available(self, key, symbols):
+        
+        # The backend only doesn't know the source if it was resent already
+        if symbols == workers.SOURCE_UNKNOWN:
+            return []
+        # Empty results are not cached, because they may be due to a timeout
+        if symbols:
+            self._cached_symbols = key, symbols
+        return symbols
@@ -0,0 +1,27 @@
+# coding=utf-8
+"""
+Tests the endpoints that are used to communicate with the language server.
+"""
+import os
+import pytest
+from pylspclient import lsp_structs
+from pyqode.language_server.backend import jsonrpc
+
+
+@pytest.fixture
+def pipe():
+
+    read_fd, write_fd = os.pipe()
+    with open(read_fd, 'rb') as stdout, open(write_fd, 'wb') as stdin:
+        yield stdin, stdout
+
+
+def test_malformed_header_is_skipped(pipe):
+
+    stdin, stdout = pipe
+    endpoint = jsonrpc.PipeEndpoint(stdin, stdout)
+    stdin.write(b'oops\r\n\r\nContent-Length: 13\r\n\r\n{"jsonrpc":1}')
+    stdin.flush()
+    with pytest.raises(lsp_structs.ResponseError):
+        endpoint.recv_response()
+    assert endpoint.recv_response() == {'jsonrpc': 1}
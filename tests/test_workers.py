@@ -0,0 +1,326 @@
+# coding=utf-8
+"""
+Tests the backend workers against a stub client that records the messages
+that would be sent to the language server.
+"""
+import time
+from types import SimpleNamespace
+import pytest
+from pyqode.language_server.backend import workers
+
+
+class StubClient:
+
+    def __init__(self):
+
+        self.lsp_endpoint = SimpleNamespace(json_rpc_endpoint=object())
+        self.messages = []
+
+    def _record(self, method, *args):
+
+        self.messages.append((method, args))
+
+    def count(self, method):
+
+        return sum(1 for m, _ in self.messages if m == method)
+
+    def didOpen(self, text_document):
+
+        self._record('didOpen', text_document)
+
+    def didChange(self, text_document, content_changes):
+
+        self._record('didChange', text_document, content_changes)
+
+    def completion(self, text_document, position, context):
+
+        self._record('completion', text_document, position)
+        return SimpleNamespace(
+            isIncomplete=False,
+            items=[
+                SimpleNamespace(
+                    insertText=text,
+                    label=text,
+                    kind=None,
+                    detail=None
+                )
+                for text in ('path', 'pathsep', 'getcwd')
+            ]
+        )
+
+    def signatureHelp(self, text_document, position):
+
+        self._record('signatureHelp', text_document, position)
+        return SimpleNamespace(
+            signatures=[
+                SimpleNamespace(
+                    label='join(a, *p)',
+                    parameters=[
+                        SimpleNamespace(label='a'),
+                        SimpleNamespace(label='*p')
+                    ],
+                    documentation='Join two or more pathname components.'
+                )
+            ],
+            activeSignature=0,
+            activeParameter=0
+        )
+
+    def documentSymbol(self, text_document):
+
+        self._record('documentSymbol', text_document)
+        return [
+            SimpleNamespace(
+                name='f',
+                kind=SimpleNamespace(name='Function'),
+                location=SimpleNamespace(
+                    range=SimpleNamespace(start=SimpleNamespace(line=0))
+                ),
+                containerName=None
+            )
+        ]
+
+
+@pytest.fixture
+def client(monkeypatch):
+
+    stub = StubClient()
+    monkeypatch.setattr(workers, 'client', stub)
+    monkeypatch.setattr(workers, 'server_status', workers.SERVER_RUNNING)
+    monkeypatch.setattr(
+        workers,
+        'server_process',
+        SimpleNamespace(pid=0, poll=lambda: None)
+    )
+    monkeypatch.setattr(workers, 'incremental_sync', True)
+    monkeypatch.setattr(workers, 'SYMBOLS_DB_PATH', None)
+    monkeypatch.setattr(workers, 'symbols_db', None)
+    for state in (
+        workers.open_documents,
+        workers.document_versions,
+        workers.sent_code,
+        workers.sync_times,
+        workers.diagnostics,
+        workers.completion_cache,
+        workers.symbols_cache,
+        workers.signatures_cache,
+        workers.frontend_code
+    ):
+        state.clear()
+    workers._path_to_uri.cache_clear()
+    return stub
+
+
+def _complete(code, prefix, path=''):
+
+    line = code.count('\n')
+    column = len(code.split('\n')[-1]) - len(prefix)
+    return workers.CompletionProvider.complete(
+        code, line, column, path, 'utf-8', prefix, False
+    )
+
+
+def _last_version(client):
+
+    for method, args in reversed(client.messages):
+        if method in ('didOpen', 'didChange'):
+            return args[0].version
+
+
+def test_complete_raises_version_by_one(client):
+
+    _complete('import os\nos.', '')
+    version = _last_version(client)
+    _complete('import sys\nsys.', '')
+    assert client.count('didOpen') == 1
+    assert client.count('didChange') == 1
+    assert _last_version(client) == version + 1
+
+
+def test_unchanged_code_is_not_sent_again(client):
+
+    _complete('import os\nos.', '')
+    workers.run_diagnostics({'path': '', 'code': 'import os\nos.'})
+    assert client.count('didOpen') == 1
+    assert client.count('didChange') == 0
+
+
+def test_completions_are_reused_while_prefix_is_extended(client):
+
+    _complete('import os\nos.pa', 'pa')
+    matches = _complete('import os\nos.pat', 'pat')
+    assert client.count('completion') == 1
+    assert matches[0]['name'] == 'path'
+
+
+def test_calltips_are_cached(client):
+
+    request_data = {
+        'code': 'import os\nos.path.join(',
+        'path': '',
+        'line': 1,
+        'column': 13
+    }
+    first = workers.calltips(dict(request_data))
+    second = workers.calltips(dict(request_data))
+    assert client.count('signatureHelp') == 1
+    assert first == second
+    assert first[0] == 'join(a, *p)'
+
+
+def test_symbols_are_cached(client):
+
+    request_data = {
+        'code': 'def f():\n    pass\n',
+        'path': '',
+        'kind': ['Function']
+    }
+    first = workers.symbols(dict(request_data))
+    second = workers.symbols(dict(request_data))
+    assert client.count('documentSymbol') == 1
+    assert first == second == [('f', 'Function', 0, None)]
+
+
+def test_symbols_are_stored_on_disk(client, monkeypatch, tmp_path):
+
+    monkeypatch.setattr(
+        workers,
+        'SYMBOLS_DB_PATH',
+        str(tmp_path / 'symbols.sqlite')
+    )
+    monkeypatch.setattr(workers, 'server_cmd', 'pylsp')
+    request_data = {
+        'code': 'def f():\n    pass\n',
+        'path': 'test.py',
+        'kind': ['Function']
+    }
+    first = workers.symbols(dict(request_data))
+    # A new connection sees the symbols without anything else being written,
+    # as when the backend is started again
+    workers.symbols_db.close()
+    workers.symbols_db = None
+    workers.symbols_cache.clear()
+    second = workers.symbols(dict(request_data))
+    workers.symbols_db.close()
+    assert client.count('documentSymbol') == 1
+    assert first == second
+
+
+def test_new_documents_share_a_single_uri(client):
+
+    # All new documents are mapped to the same temporary uri, so changes have
+    # to be based on whatever was last sent for that uri.
+    workers._sync_document('', 'import os\nos.path.join(')
+    workers._sync_document('untitled', 'x = 1\nprint(')
+    workers._sync_document('', 'import os\nos.path.join(a, ')
+    versions = [args[0].version for _, args in client.messages]
+    assert versions == sorted(set(versions))
+    assert workers.sent_code[workers._path_to_uri('')] == \
+        'import os\nos.path.join(a, \n'
+
+
+def test_diagnostics_are_only_waited_for_after_a_sync(client):
+
+    request_data = {'path': '', 'ignore_rules': []}
+    t0 = time.monotonic()
+    assert workers.poll_diagnostics(request_data) == [None]
+    assert time.monotonic() - t0 < workers.DIAGNOSTICS_WAIT
+    workers.run_diagnostics({'path': '', 'code': 'x = 1'})
+    t0 = time.monotonic()
+    assert workers.poll_diagnostics(request_data) == [None]
+    assert time.monotonic() - t0 >= workers.DIAGNOSTICS_WAIT
+
+
+def _source_request_data(channel, version, **kwargs):
+
+    return dict(path='', channel=channel, version=version, **kwargs)
+
+
+def test_edits_are_applied_to_the_code_of_their_channel(client):
+
+    workers._request_code(
+        _source_request_data('a', 0, code='import os\nos.path(')
+    )
+    workers._request_code(
+        _source_request_data('b', 0, code='x = 1\nprint(')
+    )
+    code = workers._request_code(
+        _source_request_data(
+            'a',
+            1,
+            base_version=0,
+            edit=(18, 18, 'a, '),
+            length=21
+        )
+    )
+    assert code == 'import os\nos.path(a, '
+    # An edit that doesn't fit the code is rejected rather than applied
+    code = workers._request_code(
+        _source_request_data(
+            'b',
+            1,
+            base_version=0,
+            edit=(13, 13, 'a, '),
+            length=21
+        )
+    )
+    assert code is None
+
+
+def test_diagnostics_restart_a_server_that_quit(client, monkeypatch):
+
+    restarts = []
+    monkeypatch.setattr(
+        workers,
+        'server_process',
+        SimpleNamespace(pid=0, poll=lambda: -9)
+    )
+    monkeypatch.setattr(workers, 'last_restart', None)
+    monkeypatch.setattr(
+        workers,
+        'restart_language_server',
+        lambda: restarts.append(True)
+    )
+    results = workers.run_diagnostics({'path': '', 'code': 'x = 1'})
+    assert restarts == [True]
+    assert client.count('didOpen') == 0
+    assert results['server_status'] == workers.SERVER_ERROR
+
+
+def test_diagnostics_handle_a_server_that_quits_while_syncing(
+    client,
+    monkeypatch
+):
+
+    restarts = []
+    process = SimpleNamespace(pid=0, returncode=None)
+    process.poll = lambda: process.returncode
+
+    def quit_server(text_document):
+        process.returncode = -9
+        raise BrokenPipeError()
+
+    monkeypatch.setattr(workers, 'server_process', process)
+    monkeypatch.setattr(client, 'didOpen', quit_server)
+    monkeypatch.setattr(workers, 'last_restart', None)
+    monkeypatch.setattr(
+        workers,
+        'restart_language_server',
+        lambda: restarts.append(True)
+    )
+    results = workers.run_diagnostics({'path': '', 'code': 'x = 1'})
+    assert restarts == [True]
+    assert results['server_status'] == workers.SERVER_ERROR
+
+
+def test_code_is_kept_for_a_limited_number_of_channels(client, monkeypatch):
+
+    monkeypatch.setattr(workers, 'FRONTEND_CODE_SIZE', 2)
+    for channel in 'abc':
+        workers._request_code(_source_request_data(channel, 0, code='x = 1'))
+    assert list(workers.frontend_code) == ['b', 'c']
+    # A mode that saves its document under a new name keeps a single entry
+    workers._request_code(
+        dict(path='test.py', channel='b', version=1, code='x = 2')
+    )
+    assert list(workers.frontend_code) == ['c', 'b']